@@ -1,4 +1,5 @@
 import asyncio
+import atexit
 import base64
 import datetime
 import hashlib
@@ -9,6 +10,7 @@ import random
 import re
 import secrets
 import string
+import threading
 import time
 import uuid
 from functools import wraps
@@ -116,6 +118,11 @@ limiter = Limiter(
 
 # In-memory cache
 cache = {}
+cache_lock = threading.Lock()  # Serializes cleanup passes over the cache
+
+# Shared HTTP client so stream requests reuse pooled connections to googlevideo
+http_client = httpx.Client(timeout=REQUEST_TIMEOUT)
+atexit.register(http_client.close)  # Only closed when the worker shuts down
 
 # User agents list for rotation
 USER_AGENTS = [
@@ -1624,8 +1631,39 @@ def generate_cache_key(func_name, *args, **kwargs):
     return hashlib.md5(key.encode()).hexdigest()
 
 def cached(timeout=CACHE_TIMEOUT):
-    """Decorator to cache function results"""
+    """Decorator to cache function results (sync or async)
+
+    timeout can also be a callable that takes the result and returns how long it stays valid
+    """
     def decorator(func):
+        def get_cached(cache_key):
+            # Check if result is in cache and still valid
+            cached_result = cache.get(cache_key)
+            if cached_result:
+                cached_time, result = cached_result
+                ttl = timeout(result) if callable(timeout) else timeout
+                if time.time() - cached_time < ttl:
+                    return True, result
+            return False, None
+        
+        if asyncio.iscoroutinefunction(func):
+            # Cache the awaited result, not the coroutine object
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                # Skip cache if bypass_cache is True
+                if kwargs.get('bypass_cache', False):
+                    return await func(*args, **kwargs)
+                
+                cache_key = generate_cache_key(func.__name__, *args, **kwargs)
+                hit, result = get_cached(cache_key)
+                if hit:
+                    return result
+                
+                result = await func(*args, **kwargs)
+                cache[cache_key] = (time.time(), result)
+                return result
+            return async_wrapper
+        
         @wraps(func)
         def wrapper(*args, **kwargs):
             # Skip cache if bypass_cache is True
@@ -1636,12 +1674,9 @@ def cached(timeout=CACHE_TIMEOUT):
             # Generate cache key
             cache_key = generate_cache_key(func.__name__, *args, **kwargs)
             
-            # Check if result is in cache
-            cached_result = cache.get(cache_key)
-            if cached_result:
-                cached_time, result = cached_result
-                if time.time() - cached_time < timeout:
-                    return result
+            hit, result = get_cached(cache_key)
+            if hit:
+                return result
             
             # Call the function
             result = func(*args, **kwargs)
@@ -1653,6 +1688,33 @@ def cached(timeout=CACHE_TIMEOUT):
         return wrapper
     return decorator
 
+# Googlevideo URLs carry their expiry either as ?expire=<ts> or /expire/<ts>/
+STREAM_EXPIRE_REGEX = re.compile(r"[/?&]expire[=/](\d+)")
+STREAM_EXPIRY_MARGIN = 10 * 60  # Stop handing out a stream 10 minutes before it dies
+
+def get_stream_expiry(stream_url):
+    """Get the unix time at which a googlevideo stream URL stops working"""
+    match = STREAM_EXPIRE_REGEX.search(stream_url)
+    if match:
+        return int(match.group(1))
+    return time.time() + CACHE_TIMEOUT
+
+def stream_cache_timeout(stream_path):
+    """Keep a cached stream path for as long as the URL behind it is valid"""
+    if not stream_path:
+        # Don't serve failed lookups from cache
+        return 0
+    stream_data = cache.get(f"stream:{stream_path.rsplit('/', 1)[-1]}")
+    if not stream_data:
+        return 0
+    return stream_data["expires_at"] - STREAM_EXPIRY_MARGIN - stream_data["created_at"]
+
+def details_cache_timeout(details):
+    """Keep video details for CACHE_TIMEOUT, but never cache the failure placeholder"""
+    if not details or not details.get("id"):
+        return 0
+    return CACHE_TIMEOUT
+
 def clean_ytdl_options():
     """Generate clean ytdlp options to avoid detection"""
     return {
@@ -1688,20 +1750,22 @@ def time_to_seconds(time_str):
     except:
         return 0
 
+# YouTube URL patterns, compiled once at import
+VIDEO_ID_PATTERNS = [
+    re.compile(r'(?:youtube\.com/watch\?v=|youtu\.be/|youtube\.com/embed/|youtube\.com/v/)([^&\n?#]+)'),
+    re.compile(r'youtube\.com/watch.*?v=([^&\n?#]+)'),
+    re.compile(r'youtube\.com/shorts/([^&\n?#]+)')
+]
+YOUTUBE_URL_REGEX = re.compile(r"(?:youtube\.com|youtu\.be)")
+VIDEO_ID_REGEX = re.compile(r'^[a-zA-Z0-9_-]{11}$')
+
 def extract_video_id(url):
     """Extract video ID from YouTube URL"""
     if not url:
         return None
     
-    # YouTube URL patterns
-    patterns = [
-        r'(?:youtube\.com/watch\?v=|youtu\.be/|youtube\.com/embed/|youtube\.com/v/)([^&\n?#]+)',
-        r'youtube\.com/watch.*?v=([^&\n?#]+)',
-        r'youtube\.com/shorts/([^&\n?#]+)'
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, url)
+    for pattern in VIDEO_ID_PATTERNS:
+        match = pattern.search(url)
         if match:
             return match.group(1)
     
@@ -1711,8 +1775,7 @@ def is_youtube_url(url):
     """Check if a URL is a valid YouTube URL"""
     if not url:
         return False
-    regex = r"(?:youtube\.com|youtu\.be)"
-    return re.search(regex, url) is not None
+    return YOUTUBE_URL_REGEX.search(url) is not None
 
 def normalize_url(url, video_id=None):
     """Normalize YouTube URL"""
@@ -1724,12 +1787,35 @@ def normalize_url(url, video_id=None):
     
     return url
 
-def log_api_request(api_key_str, endpoint, query=None, status=200):
-    """Log API request to database"""
+def video_details_from_info(info):
+    """Build the video details dict from a yt-dlp info dict"""
+    video_id = info.get("id", "")
+    title = info.get("title", "Unknown")
+    duration = info.get("duration", 0)
+    
+    # Format duration
+    duration_text = str(datetime.timedelta(seconds=duration)) if duration else "0:00"
+    if duration_text.startswith('0:'):
+        duration_text = duration_text[2:]
+    
+    thumbnail = info.get("thumbnail", "")
+    channel = info.get("uploader", "")
+    views = info.get("view_count", 0)
+    
+    return {
+        "id": video_id,
+        "title": title,
+        "duration": duration,
+        "duration_text": duration_text,
+        "channel": channel,
+        "views": views,
+        "thumbnail": thumbnail,
+        "link": f"https://www.youtube.com/watch?v={video_id}"
+    }
+
+def log_api_request(api_key, endpoint, query=None, status=200):
+    """Log API request to database using the ApiKey row the caller already loaded"""
     try:
-        # Find the API key in the database
-        api_key = ApiKey.query.filter_by(key=api_key_str).first()
-        
         if api_key:
             # Update the usage counter
             api_key.count += 1
@@ -1752,7 +1838,7 @@ def log_api_request(api_key_str, endpoint, query=None, status=200):
             db.session.add(log)
             db.session.commit()
     except Exception as e:
-        logger.error(f"Error logging API request: {e}")
+        logger.error("Error logging API request: %s", e)
         db.session.rollback()
 
 def required_api_key(func):
@@ -1793,7 +1879,7 @@ def required_api_key(func):
             else:
                 query = None
                 
-            log_api_request(api_key_str, request.path, query, 
+            log_api_request(api_key, request.path, query, 
                             response[1] if isinstance(response, tuple) else 200)
             
             return response
@@ -1804,7 +1890,7 @@ def required_api_key(func):
             else:
                 query = None
                 
-            log_api_request(api_key_str, request.path, query, 500)
+            log_api_request(api_key, request.path, query, 500)
             raise e
     
     return decorated_function
@@ -1903,7 +1989,7 @@ class YouTubeAPIService:
                 
                 return videos
         except Exception as e:
-            logger.error(f"Error searching videos: {e}")
+            logger.error("Error searching videos: %s", e)
             return []
     
     @staticmethod
@@ -1927,11 +2013,11 @@ class YouTubeAPIService:
                 ydl.extract_info(url, download=False, process=False)
                 return True
         except Exception as e:
-            logger.error(f"Error checking if URL exists: {e}")
+            logger.error("Error checking if URL exists: %s", e)
             return False
     
     @staticmethod
-    @cached()
+    @cached(timeout=details_cache_timeout)
     async def get_details(url, video_id=None):
         """Get video details"""
         try:
@@ -1962,32 +2048,9 @@ class YouTubeAPIService:
             
             with yt_dlp.YoutubeDL(options) as ydl:
                 info = ydl.extract_info(url, download=False)
-                
-                video_id = info.get("id", "")
-                title = info.get("title", "Unknown")
-                duration = info.get("duration", 0)
-                
-                # Format duration
-                duration_text = str(datetime.timedelta(seconds=duration)) if duration else "0:00"
-                if duration_text.startswith('0:'):
-                    duration_text = duration_text[2:]
-                
-                thumbnail = info.get("thumbnail", "")
-                channel = info.get("uploader", "")
-                views = info.get("view_count", 0)
-                
-                return {
-                    "id": video_id,
-                    "title": title,
-                    "duration": duration,
-                    "duration_text": duration_text,
-                    "channel": channel,
-                    "views": views,
-                    "thumbnail": thumbnail,
-                    "link": f"https://www.youtube.com/watch?v={video_id}"
-                }
+                return video_details_from_info(info)
         except Exception as e:
-            logger.error(f"Error getting video details: {e}")
+            logger.error("Error getting video details: %s", e)
             return {
                 "id": "",
                 "title": "Unknown",
@@ -2000,7 +2063,7 @@ class YouTubeAPIService:
             }
     
     @staticmethod
-    @cached()
+    @cached(timeout=stream_cache_timeout)
     async def get_stream_url(url, is_video=False, video_id=None):
         """Get stream URL for a video"""
         try:
@@ -2034,14 +2097,16 @@ class YouTubeAPIService:
                 else:
                     formats = info.get('formats', [])
                     if formats:
-                        for fmt in formats:
-                            if (is_video and fmt.get('height', 0) <= 720 and fmt.get('acodec', 'none') != 'none') or \
-                               (not is_video and fmt.get('acodec', 'none') != 'none' and fmt.get('vcodec', '') == 'none'):
-                                stream_url = fmt.get('url', '')
-                                break
+                        # Pick the filter once instead of re-checking is_video for every format
+                        if is_video:
+                            matches = (fmt for fmt in formats
+                                       if fmt.get('vcodec', 'none') != 'none' and fmt.get('acodec', 'none') != 'none'
+                                       and fmt.get('height') is not None and fmt['height'] <= 720)
                         else:
-                            # If no suitable format found, use the best available
-                            stream_url = formats[-1].get('url', '')
+                            matches = (fmt for fmt in formats
+                                       if fmt.get('vcodec', '') == 'none' and fmt.get('acodec', 'none') != 'none')
+                        # If no suitable format found, use the best available
+                        stream_url = next(matches, formats[-1]).get('url', '')
                     else:
                         raise ValueError("No suitable formats found")
                 
@@ -2053,6 +2118,7 @@ class YouTubeAPIService:
                 cache[stream_key] = {
                     "url": stream_url,
                     "created_at": time.time(),
+                    "expires_at": get_stream_expiry(stream_url),
                     "is_video": is_video,
                     "info": info
                 }
@@ -2060,17 +2126,35 @@ class YouTubeAPIService:
                 # Return our proxied stream URL
                 return f"/stream/{stream_id}"
         except Exception as e:
-            logger.error(f"Error getting stream URL: {e}")
+            logger.error("Error getting stream URL: %s", e)
             return ""
 
+# Event loop reused for requests served on the main thread (gunicorn sync workers)
+_main_loop = None
+
+def close_main_loop():
+    """Close the reused main-thread event loop on shutdown"""
+    if _main_loop is not None and not _main_loop.is_closed():
+        _main_loop.close()
+
+atexit.register(close_main_loop)
+
 def run_async(func, *args, **kwargs):
     """Run an async function from a synchronous context with arguments"""
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        return loop.run_until_complete(func(*args, **kwargs))
-    finally:
-        loop.close()
+    global _main_loop
+    if threading.current_thread() is not threading.main_thread():
+        # Request threads (e.g. the threaded dev server) may be short-lived, so don't leave a loop behind
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(func(*args, **kwargs))
+        finally:
+            loop.close()
+    
+    if _main_loop is None or _main_loop.is_closed():
+        _main_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_main_loop)
+    return _main_loop.run_until_complete(func(*args, **kwargs))
 
 def init_db_data():
     """Initialize database with default data"""
@@ -2125,7 +2209,7 @@ def init_db_data():
                 
                 db.session.commit()
     except Exception as e:
-        logger.error(f"Error initializing database: {e}")
+        logger.error("Error initializing database: %s", e)
 
 # Routes
 @app.route("/", methods=["GET"])
@@ -2151,7 +2235,7 @@ def youtube():
     
     # Determine if this is a search query or a direct video ID/URL
     is_url = is_youtube_url(query)
-    is_video_id = re.match(r'^[a-zA-Z0-9_-]{11}$', query)
+    is_video_id = VIDEO_ID_REGEX.match(query)
     
     try:
         # Handle search case
@@ -2191,14 +2275,18 @@ def youtube():
         # Handle direct video case
         video_url = query if is_url else f"https://www.youtube.com/watch?v={query}"
         
-        # Get video details
-        video_details = run_async(YouTubeAPIService.get_details, video_url)
+        # Get stream URL; its extraction already carries the video details
+        stream_url = run_async(YouTubeAPIService.get_stream_url, video_url, is_video=video)
+        stream_data = cache.get(f"stream:{stream_url.rsplit('/', 1)[-1]}") if stream_url else None
+        
+        if stream_data and stream_data.get("info"):
+            video_details = video_details_from_info(stream_data["info"])
+        else:
+            # Fall back to a separate details lookup
+            video_details = run_async(YouTubeAPIService.get_details, video_url)
         
         if not video_details or not video_details.get("id"):
             return jsonify({"error": "No video found"}), 404
-            
-        # Get stream URL
-        stream_url = run_async(YouTubeAPIService.get_stream_url, video_url, is_video=video)
         
         if not stream_url:
             return jsonify({"error": "Failed to get stream URL"}), 500
@@ -2221,7 +2309,7 @@ def youtube():
         
         return jsonify(response)
     except Exception as e:
-        logger.error(f"Error in YouTube endpoint: {e}")
+        logger.error("Error in YouTube endpoint: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/stream/<stream_id>", methods=["GET"])
@@ -2253,7 +2341,7 @@ def stream_media(stream_id):
                 "Range": request.headers.get("Range", "bytes=0-")
             }
             
-            with httpx.stream("GET", url, headers=headers, timeout=30) as response:
+            with http_client.stream("GET", url, headers=headers, timeout=30) as response:
                 # Forward content type and other headers
                 yield b""
                 
@@ -2261,7 +2349,7 @@ def stream_media(stream_id):
                 for chunk in response.iter_bytes(chunk_size=buffer_size):
                     yield chunk
         except Exception as e:
-            logger.error(f"Streaming error: {e}")
+            logger.error("Streaming error: %s", e)
             yield b""
     
     # Create a streaming response
@@ -2322,7 +2410,7 @@ def get_metrics():
             "key_distribution": key_distribution
         })
     except Exception as e:
-        logger.error(f"Error getting metrics: {e}")
+        logger.error("Error getting metrics: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/admin/list_api_keys", methods=["GET"])
@@ -2346,7 +2434,7 @@ def list_api_keys():
         
         return jsonify(keys)
     except Exception as e:
-        logger.error(f"Error listing API keys: {e}")
+        logger.error("Error listing API keys: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/admin/create_api_key", methods=["POST"])
@@ -2395,7 +2483,7 @@ def create_api_key():
             "is_admin": is_admin
         })
     except Exception as e:
-        logger.error(f"Error creating API key: {e}")
+        logger.error("Error creating API key: %s", e)
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
 
@@ -2421,7 +2509,7 @@ def revoke_api_key():
         
         return jsonify({"success": True, "message": "API key revoked"})
     except Exception as e:
-        logger.error(f"Error revoking API key: {e}")
+        logger.error("Error revoking API key: %s", e)
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
 
@@ -2449,7 +2537,7 @@ def recent_logs():
         
         return jsonify(logs)
     except Exception as e:
-        logger.error(f"Error getting recent logs: {e}")
+        logger.error("Error getting recent logs: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/api/cleanup", methods=["POST"])
@@ -2460,27 +2548,28 @@ def cleanup_old_files():
         # Expire time (1 day)
         expire_time = time.time() - (24 * 60 * 60)
         
-        # Clean up cache
-        keys_to_remove = []
-        for key, value in cache.items():
-            if isinstance(value, tuple) and len(value) > 0 and isinstance(value[0], (int, float)):
-                timestamp, _ = value
-                if timestamp < expire_time:
-                    keys_to_remove.append(key)
-            elif isinstance(value, dict) and "created_at" in value:
-                if value["created_at"] < expire_time:
-                    keys_to_remove.append(key)
+        # Clean up cache under the lock, scanning a snapshot so concurrent inserts can't break iteration
+        with cache_lock:
+            keys_to_remove = []
+            for key, value in list(cache.items()):
+                if isinstance(value, tuple) and len(value) > 0 and isinstance(value[0], (int, float)):
+                    timestamp, _ = value
+                    if timestamp < expire_time:
+                        keys_to_remove.append(key)
+                elif isinstance(value, dict) and "created_at" in value:
+                    if value["created_at"] < expire_time:
+                        keys_to_remove.append(key)
                     
-                    # If it's a download, remove the file
-                    if key.startswith("download:") and "path" in value:
-                        try:
-                            if os.path.exists(value["path"]):
-                                os.remove(value["path"])
-                        except Exception as e:
-                            logger.error(f"Error removing file: {e}")
+                        # If it's a download, remove the file
+                        if key.startswith("download:") and "path" in value:
+                            try:
+                                if os.path.exists(value["path"]):
+                                    os.remove(value["path"])
+                            except Exception as e:
+                                logger.error("Error removing file: %s", e)
         
-        for key in keys_to_remove:
-            cache.pop(key, None)
+            for key in keys_to_remove:
+                cache.pop(key, None)
         
         # Clean up download directory
         for filename in os.listdir(DOWNLOAD_DIR):
@@ -2491,14 +2580,14 @@ def cleanup_old_files():
                     if os.path.isfile(filepath):
                         os.remove(filepath)
             except Exception as e:
-                logger.error(f"Error removing old file: {e}")
+                logger.error("Error removing old file: %s", e)
         
         return jsonify({
             "success": True,
             "message": f"Cleaned up {len(keys_to_remove)} cache entries and old downloads"
         })
     except Exception as e:
-        logger.error(f"Error during cleanup: {e}")
+        logger.error("Error during cleanup: %s", e)
         return jsonify({"error": str(e)}), 500
 
 # Error handlers